@@ -11,16 +11,71 @@ import win32con
 import win32process
 import psutil
 import threading
+import queue
 import json
 import http.client
 import logging
 import shutil
 import re
+import sqlite3
+import difflib
+import gc
+import tracemalloc
+import io
+from array import array
 
 APP_PID = os.getpid()
-DOUBLE_TAP_MAX_DELAY = 0.35  # seconds between taps
+DOUBLE_TAP_MAX_DELAY = 0.3  # seconds between taps
 last_shift_time = 0
 DEBUG = bool(os.environ.get('REPHRASER_DEBUG'))
+RESULT_CHUNK_LINES = 500  # lines appended to the overlay per event-loop pass
+OVERLAY_SCREEN_MARGIN = 20  # keep the overlay this far from the screen edges
+OVERLAY_CHROME_WIDTH = 40  # frame margins and scrollbar around the text
+OVERLAY_CHROME_HEIGHT = 80  # close button, instruction label and margins
+SESSION_MEMORY_SIZE = 8  # recent selections remembered for delta rephrasing
+SESSION_MIN_SIMILARITY = 0.5  # how alike a selection must be to reuse its lines
+SESSION_MAX_CHARS = 1_000_000  # rephrased characters kept across remembered selections
+SESSION_MAX_SELECTION_CHARS = 200_000  # larger selections are neither remembered nor reused
+MAX_PROMPT_TOKENS = 512  # cap on the user-editable part of the system prompt
+USAGE_DB_FILE = './assets/usage.db'
+USAGE_RAW_RETENTION_DAYS = 30  # older requests are folded into daily rollups
+USAGE_ROLLUP_INTERVAL = 50  # requests recorded between rollups
+
+class SessionRecorder:
+    """Opt-in recorder that appends timestamped session events to a JSON-lines replay file."""
+
+    def __init__(self, path=None):
+        self.started = time.perf_counter()
+        self.events = queue.SimpleQueue()
+        self.enabled = bool(path)
+        self.writer = None
+        if self.enabled:
+            self.writer = threading.Thread(target=self.write_events, args=(path,), name='SessionRecorder', daemon=True)
+            self.writer.start()
+
+    def record(self, kind, **data):
+        # Cheap enough for the keyboard hook; serialization happens on the writer thread
+        if self.enabled:
+            self.events.put((time.perf_counter() - self.started, kind, data))
+
+    def write_events(self, path):
+        with open(path, 'a', encoding='utf-8') as f:
+            while True:
+                event = self.events.get()
+                if event is None:
+                    break
+                t, kind, data = event
+                f.write(json.dumps({'t': round(t, 6), 'kind': kind, **data}) + '\n')
+                f.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.enabled = False
+            self.events.put(None)
+            self.writer.join(timeout=2)
+            self.writer = None
+
+recorder = SessionRecorder(os.environ.get('REPHRASER_RECORD'))
 
 def is_own_window_focused():
     try:
@@ -31,12 +86,13 @@ def is_own_window_focused():
         print(f"[is_own_window_focused] Exception: {e}")
         return False
 
+def get_window_exe(hwnd):
+    _, pid = win32process.GetWindowThreadProcessId(hwnd)
+    return psutil.Process(pid).name().lower()
+
 def is_supported_app_focused():
     try:
-        hwnd = win32gui.GetForegroundWindow()
-        _, pid = win32process.GetWindowThreadProcessId(hwnd)
-        proc = psutil.Process(pid)
-        exe = proc.name().lower()
+        exe = get_window_exe(win32gui.GetForegroundWindow())
         return exe in settings.get('supported_apps', [])
     except Exception as e:
         debug_print('[DEBUG] is_supported_app_focused error:', e)
@@ -60,12 +116,136 @@ DEFAULT_SETTINGS = {
     'api_url': 'https://api.openai.com/v1',
     'model': 'gpt-3.5-turbo',
     'prompt': 'You are a helpful assistant that rephrases text in a clear and concise way.',
-    'supported_apps': ['outlook.exe', 'notepad.exe', 'chrome.exe']
+    'supported_apps': ['outlook.exe', 'notepad.exe', 'chrome.exe'],
+    'token_prices': {},  # model -> [prompt, completion, optional cached prompt] price per million tokens
+    'response_formats': {}  # "api_url|model" -> structured output mode found by probing
 }
 settings = {}
 
+# Kept first and byte-identical across requests so providers that cache
+# prompt prefixes can reuse it; the user prompt follows.
+REPHRASE_INSTRUCTIONS = (
+    "You will be given a JSON object with a key 'lines_to_rephrase' containing a list of strings. "
+    "These strings are all part of the same email or message and must be understood in that shared context. "
+    "Your task is to rephrase each line while preserving the meaning and tone appropriate to the overall message. "
+    "Pay attention to how the lines relate to one another to maintain consistency, flow, and coherence. "
+    "You MUST respond with a JSON object containing a single key, 'rephrased_lines', which is a list of the rephrased strings. "
+    "The output list should have the exact same number of items, in the same order, as the input list. "
+    "If a 'context' key is present, it holds neighbouring lines of the message for reference only; do not rephrase or return them."
+)
+system_prompt_info = ('', 0)  # (system prompt, estimated tokens) for the loaded settings
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+def compact_prompt(prompt):
+    # Collapse whitespace and cap the user prompt so it cannot grow every request unbounded
+    compacted = ' '.join(prompt.split())
+    max_chars = MAX_PROMPT_TOKENS * 4
+    if len(compacted) > max_chars:
+        debug_print(f'[DEBUG] Prompt truncated from {len(compacted)} to {max_chars} characters')
+        compacted = compacted[:max_chars].rsplit(' ', 1)[0]
+    return compacted
+
+def build_system_prompt(prompt):
+    system_prompt = REPHRASE_INSTRUCTIONS
+    user_prompt = compact_prompt(prompt)
+    if user_prompt:
+        system_prompt += '\n\n' + user_prompt
+    return system_prompt, estimate_tokens(system_prompt)
+
+# Structured output modes in order of preference; 'text' sends no response_format
+RESPONSE_FORMATS = {
+    'json_schema': {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "rephrased_lines",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"rephrased_lines": {"type": "array", "items": {"type": "string"}}},
+                "required": ["rephrased_lines"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    'json_object': {"type": "json_object"},
+    'text': None,
+}
+
+def response_format_key(api_url, model):
+    return f'{api_url}|{model}'
+
+class ResponseFormatCache(QtCore.QObject):
+    """Structured output modes negotiated by workers, saved to the settings on the GUI thread."""
+
+    learned = QtCore.pyqtSignal(str, str)
+
+    def __init__(self):
+        super().__init__()
+        self.formats = {}
+        self.lock = threading.Lock()
+        # Workers emit learned from their own thread, so persist() runs queued on the GUI thread
+        self.learned.connect(self.persist)
+
+    def get(self, api_url, model):
+        key = response_format_key(api_url, model)
+        response_format = settings.get('response_formats', {}).get(key)
+        if response_format is None:
+            with self.lock:
+                response_format = self.formats.get(key)
+        return response_format if response_format in RESPONSE_FORMATS else None
+
+    def remember(self, api_url, model, response_format):
+        key = response_format_key(api_url, model)
+        with self.lock:
+            self.formats[key] = response_format
+        self.learned.emit(key, response_format)
+
+    def persist(self, key, response_format):
+        settings['response_formats'] = {**settings.get('response_formats', {}), key: response_format}
+        save_settings()
+
+response_format_cache = ResponseFormatCache()
+
+def probe_response_format(client, model):
+    # Asks for a tiny reply in each structured mode, richest first
+    messages = [
+        {"role": "system", "content": REPHRASE_INSTRUCTIONS},
+        {"role": "user", "content": json.dumps({"lines_to_rephrase": ["Thanks for the update."]})}
+    ]
+    for name, response_format in RESPONSE_FORMATS.items():
+        if response_format is None:
+            return name
+        try:
+            client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=32,
+                response_format=response_format,
+                timeout=20.0
+            )
+            return name
+        except openai.BadRequestError as e:
+            if not is_response_format_error(e):
+                raise
+            debug_print(f'[DEBUG] {name} output not supported by {model}:', e)
+
+def is_response_format_error(error):
+    # A rejected structured output mode names the response_format parameter or the
+    # mode; any other 400 (context length, bad model) fails the same way in every mode
+    if 'response_format' in (getattr(error, 'param', None) or ''):
+        return True
+    message = str(error).lower()
+    return any(term in message for term in ('response_format', 'json_schema', 'json_object', 'json mode', 'structured output'))
+
+def get_cached_tokens(usage):
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(details, 'cached_tokens', None) or 0
+
 def load_settings():
-    global settings
+    global settings, system_prompt_info
     loaded = DEFAULT_SETTINGS.copy()
     if os.path.exists(SETTINGS_FILE):
         try:
@@ -74,8 +254,11 @@ def load_settings():
                 loaded.update(data)
         except Exception as e:
             print(f"[load_settings] Error: {e}")
-    settings.clear()
+    # Update in place so other threads never see the settings half empty
+    for key in [key for key in settings if key not in loaded]:
+        del settings[key]
     settings.update(loaded)
+    system_prompt_info = build_system_prompt(settings['prompt'])
     openai.api_key = settings['api_key']
     openai.base_url = settings['api_url']
 
@@ -106,13 +289,43 @@ def get_icon_path():
         return ico_path_base
     return png_path_base
 
+_app_icon = None
+
+def get_app_icon():
+    # The icon is loaded from disk once and shared by every window
+    global _app_icon
+    if _app_icon is None:
+        _app_icon = QtGui.QIcon(get_icon_path())
+    return _app_icon
+
+class WidgetPool:
+    """Keeps pre-built widgets so each trigger reuses a hidden one instead of constructing it."""
+
+    def __init__(self, factory, size=1):
+        self.factory = factory
+        self.size = size
+        self.widgets = []
+
+    def prewarm(self):
+        while len(self.widgets) < self.size:
+            self.widgets.append(self.factory())
+
+    def acquire(self):
+        for widget in self.widgets:
+            if not widget.isVisible():
+                return widget
+        widget = self.factory()
+        self.widgets.append(widget)
+        debug_print(f'[DEBUG] WidgetPool grew to {len(self.widgets)} {self.factory.__name__} widgets')
+        return widget
+
 class FloatingButton(QtWidgets.QWidget):
     overlay_created = QtCore.pyqtSignal(object)
 
-    def __init__(self, selected_text, source_hwnd, parent=None):
+    def __init__(self, parent=None):
         super().__init__(parent)
-        self.selected_text = selected_text
-        self.source_hwnd = source_hwnd
+        self.selected_text = ''
+        self.source_hwnd = None
         self.setWindowFlags(
             QtCore.Qt.FramelessWindowHint |
             QtCore.Qt.WindowStaysOnTopHint |
@@ -120,12 +333,19 @@ class FloatingButton(QtWidgets.QWidget):
         )
         self.setAttribute(QtCore.Qt.WA_TranslucentBackground)
         self.init_ui()
-        QtCore.QTimer.singleShot(5000, self.close)
+        self.close_timer = QtCore.QTimer(self)
+        self.close_timer.setSingleShot(True)
+        self.close_timer.timeout.connect(self.close)
+
+    def start(self, selected_text, source_hwnd):
+        self.selected_text = selected_text
+        self.source_hwnd = source_hwnd
+        self.button.setEnabled(True)
 
     def init_ui(self):
         layout = QtWidgets.QVBoxLayout()
         self.button = QtWidgets.QPushButton()
-        self.button.setIcon(QtGui.QIcon(get_icon_path()))
+        self.button.setIcon(get_app_icon())
         self.button.setIconSize(QtCore.QSize(40, 40))
         self.button.setFixedSize(65, 65)
         self.button.setStyleSheet('border: none; background: transparent;')
@@ -135,7 +355,8 @@ class FloatingButton(QtWidgets.QWidget):
         self.setFixedSize(65, 65)
     def rephrase_text(self):
         self.button.setEnabled(False)
-        overlay = RephraseOverlay(self.selected_text, self.source_hwnd)
+        overlay = overlay_pool.acquire()
+        overlay.start(self.selected_text, self.source_hwnd)
         overlay.show_near_cursor()
         self.overlay_created.emit(overlay)
         self.close()
@@ -144,14 +365,225 @@ class FloatingButton(QtWidgets.QWidget):
         pos = QtGui.QCursor.pos()
         self.move(pos.x() + 20, pos.y())
         self.show()
+        self.close_timer.start(5000)
         debug_print('[DEBUG] FloatingButton shown at', pos.x() + 20, pos.y())
 
-class RephraseWorker(QtCore.QThread):
+class UsageLedger:
+    """Append-only SQLite ledger of API usage, rolled up per day once requests age out."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS requests (
+            ts REAL NOT NULL,
+            app TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL,
+            latency_ms REAL,  -- NULL when session memory answered without a request
+            cache_hit INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS requests_ts ON requests (ts);
+        CREATE TABLE IF NOT EXISTS daily_usage (
+            day TEXT NOT NULL,
+            app TEXT NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL,
+            cache_hits INTEGER NOT NULL,
+            PRIMARY KEY (day, app, model)
+        );
+    """
+
+    def __init__(self, path=USAGE_DB_FILE):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+        self.records_since_rollup = 0
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.executescript(self.SCHEMA)
+        return self.conn
+
+    def record(self, app, model, prompt_tokens, completion_tokens, cached_tokens, latency_ms, cache_hit):
+        try:
+            with self.lock:
+                conn = self.connect()
+                with conn:
+                    conn.execute(
+                        'INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (time.time(), app, model, prompt_tokens, completion_tokens, cached_tokens, latency_ms, int(cache_hit))
+                    )
+                self.records_since_rollup += 1
+                if self.records_since_rollup >= USAGE_ROLLUP_INTERVAL:
+                    self.rollup()
+        except Exception as e:
+            debug_print('[DEBUG] Failed to record usage:', e)
+
+    def rollup(self):
+        # Folds raw requests older than the retention window into daily totals
+        conn = self.connect()
+        cutoff = time.time() - USAGE_RAW_RETENTION_DAYS * 86400
+        with conn:
+            conn.execute("""
+                INSERT INTO daily_usage
+                SELECT date(ts, 'unixepoch', 'localtime') AS day, app, model, COUNT(*),
+                       SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens), SUM(cache_hit)
+                FROM requests WHERE ts < ? GROUP BY day, app, model
+                ON CONFLICT (day, app, model) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    cached_tokens = cached_tokens + excluded.cached_tokens,
+                    cache_hits = cache_hits + excluded.cache_hits
+            """, (cutoff,))
+            conn.execute('DELETE FROM requests WHERE ts < ?', (cutoff,))
+        self.records_since_rollup = 0
+
+    def summary(self, group_by):
+        # Rows of (app or model, requests, prompt tokens, cached prompt tokens,
+        # completion tokens, cache hits, spend, p50 latency, p95 latency). Token
+        # totals cover all history; latency percentiles cover the raw retention
+        # window. Cached prompt tokens are billed at the model's cached price,
+        # or at the prompt price when none is set.
+        if group_by not in ('app', 'model'):
+            raise ValueError(f'Cannot group usage by {group_by!r}')
+        prices = settings.get('token_prices', {})
+        with self.lock:
+            conn = self.connect()
+            totals = conn.execute("""
+                SELECT app, model, SUM(requests), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens),
+                       SUM(cache_hits)
+                FROM (
+                    SELECT app, model, requests, prompt_tokens, cached_tokens, completion_tokens, cache_hits
+                    FROM daily_usage
+                    UNION ALL
+                    SELECT app, model, 1, prompt_tokens, cached_tokens, completion_tokens, cache_hit FROM requests
+                ) GROUP BY app, model
+            """).fetchall()
+            latencies = conn.execute(
+                f'SELECT {group_by}, latency_ms FROM requests WHERE latency_ms IS NOT NULL '
+                f'ORDER BY {group_by}, latency_ms'
+            ).fetchall()
+        rows = {}
+        for app, model, requests, prompt_tokens, cached_tokens, completion_tokens, cache_hits in totals:
+            key = app if group_by == 'app' else model
+            model_prices = prices.get(model, (0, 0))
+            prompt_price, completion_price = model_prices[:2]
+            cached_price = model_prices[2] if len(model_prices) > 2 else prompt_price
+            spend = (
+                (prompt_tokens - cached_tokens) * prompt_price
+                + cached_tokens * cached_price
+                + completion_tokens * completion_price
+            ) / 1_000_000
+            values = (requests, prompt_tokens, cached_tokens, completion_tokens, cache_hits, spend)
+            previous = rows.get(key, (0, 0, 0, 0, 0, 0.0))
+            rows[key] = tuple(total + value for total, value in zip(previous, values))
+        samples = {}
+        for key, latency_ms in latencies:
+            samples.setdefault(key, []).append(latency_ms)
+        summary = []
+        for key in sorted(rows):
+            values = samples.get(key, [])
+            p50 = values[int(0.50 * (len(values) - 1))] if values else None
+            p95 = values[int(0.95 * (len(values) - 1))] if values else None
+            summary.append((key,) + rows[key] + (p50, p95))
+        return summary
+
+usage_ledger = UsageLedger()
+
+class ManagedThread(QtCore.QThread):
+    """QThread that stays referenced while it runs and is deleted once it finishes."""
+
+    live = set()
+
+    def __init__(self):
+        super().__init__()
+        self.finished.connect(self.reclaim)
+
+    def start(self, *args):
+        ManagedThread.live.add(self)
+        super().start(*args)
+
+    def reclaim(self):
+        ManagedThread.live.discard(self)
+        self.deleteLater()
+
+    @classmethod
+    def wait_all(cls, timeout_ms=3000):
+        for thread in list(cls.live):
+            thread.wait(timeout_ms)
+
+def collect_diagnostics():
+    app = QtWidgets.QApplication.instance()
+    return {
+        'live_qthreads': len(ManagedThread.live),
+        'python_threads': threading.active_count(),
+        'widgets': len(app.allWidgets()) if app else 0,
+        'top_level_widgets': len(app.topLevelWidgets()) if app else 0,
+        'pooled_overlays': len(overlay_pool.widgets),
+        'pooled_notifications': len(notification_pool.widgets),
+        'traced_memory_kb': tracemalloc.get_traced_memory()[0] // 1024 if tracemalloc.is_tracing() else None,
+    }
+
+class RephraseSession:
+    """Remembers recent selections so a re-trigger only resends the lines that changed."""
+
+    def __init__(self, size=SESSION_MEMORY_SIZE, max_chars=SESSION_MAX_CHARS):
+        self.size = size
+        self.max_chars = max_chars
+        # (context, line hashes, {line index: rephrased line}, rephrased characters) oldest first
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def reuse(self, context, line_hashes):
+        # Returns {line index: rephrased line} for lines that a recent, similar
+        # selection already rephrased with the same model and system prompt
+        # (the context). Re-selecting text that was already rephrased asks for
+        # a fresh rephrasing of every line, even when an earlier, similar
+        # selection could supply some of them.
+        with self.lock:
+            entries = [entry for entry in self.entries if entry[0] == context]
+        if any(prev_hashes == line_hashes for _, prev_hashes, _, _ in entries):
+            return {}
+        best = {}
+        for _, prev_hashes, prev_rephrased, _ in reversed(entries):
+            matcher = difflib.SequenceMatcher(None, prev_hashes, line_hashes)
+            if matcher.real_quick_ratio() < SESSION_MIN_SIMILARITY or matcher.quick_ratio() < SESSION_MIN_SIMILARITY:
+                continue
+            reused = {}
+            for prev_start, start, size in matcher.get_matching_blocks():
+                for offset in range(size):
+                    rephrased = prev_rephrased.get(prev_start + offset)
+                    if rephrased is not None:
+                        reused[start + offset] = rephrased
+            if len(reused) > len(best):
+                best = reused
+        return best
+
+    def remember(self, context, line_hashes, rephrased):
+        chars = sum(len(line) for line in rephrased.values())
+        with self.lock:
+            self.entries = [entry for entry in self.entries if entry[:2] != (context, line_hashes)]
+            self.entries.append((context, line_hashes, rephrased, chars))
+            del self.entries[:-self.size]
+            # Oldest entries go first once the kept text outgrows the cap
+            total = sum(entry[3] for entry in self.entries)
+            while self.entries and total > self.max_chars:
+                total -= self.entries.pop(0)[3]
+
+rephrase_session = RephraseSession()
+
+class RephraseWorker(ManagedThread):
     result_ready = QtCore.pyqtSignal(str, bool)
 
-    def __init__(self, selected_text):
+    def __init__(self, selected_text, source_hwnd=None):
         super().__init__()
         self.selected_text = selected_text
+        self.source_hwnd = source_hwnd
 
     def run(self):
         try:
@@ -159,139 +591,257 @@ class RephraseWorker(QtCore.QThread):
             openai.api_key = settings['api_key']
             openai.base_url = settings['api_url']
 
-            # Normalize line endings and split into lines
+            # Normalize line endings once; lines are then addressed by offsets into this buffer
             normalized_text = self.selected_text.replace('\r\n', '\n').replace('\r', '\n')
-            lines = normalized_text.split('\n')
-            reconstructed_lines = list(lines)
-            
-            lines_to_rephrase_map = {}  # Maps original index to the line content
-            for idx, line in enumerate(lines):
-                # Only rephrase lines that have actual content (not just whitespace)
-                # and are not comments or code-like
-                if line.strip() and not (
-                    line.strip().startswith('#') or
-                    line.strip().startswith('%') or
-                    self.is_code_like(line)
-                ):
-                    lines_to_rephrase_map[idx] = line
-
-            if not lines_to_rephrase_map:
+            line_starts = self.find_line_starts(normalized_text)
+            line_count = len(line_starts) - 1
+            line_hashes = array('q')
+            rephrasable_indices = array('l')
+            for idx in range(line_count):
+                line = normalized_text[line_starts[idx]:line_starts[idx + 1] - 1]
+                line_hashes.append(hash(line))
+                if self.is_rephrasable(line):
+                    rephrasable_indices.append(idx)
+
+            if not rephrasable_indices:
                 self.result_ready.emit(self.selected_text, False)
                 return
 
-            lines_to_send = list(lines_to_rephrase_map.values())
-            debug_print(f'[DEBUG] Total lines: {len(lines)}, Lines to rephrase: {len(lines_to_send)}')
-            debug_print(f'[DEBUG] Lines to rephrase indices: {list(lines_to_rephrase_map.keys())}')
-            input_json_str = json.dumps({"lines_to_rephrase": lines_to_send})
-
-            system_prompt = (
-                settings['prompt']
-                #+ " You will be given a JSON object with a key 'lines_to_rephrase' containing a list of strings. "
-                #+ "Your task is to rephrase each string in the list. "
-                #+ "You MUST respond with a JSON object that contains a single key, 'rephrased_lines', "
-                #+ "which is a list of the rephrased strings. "
-                #+ "The returned list must have the exact same number of items as the input list."
-                #+ "Most of the time, these lines are all part of the same email or text. "
-                + "You will be given a JSON object with a key 'lines_to_rephrase' containing a list of strings. "
-                + "These strings are all part of the same email or message and must be understood in that shared context."
-                + "Your task is to rephrase each line while preserving the meaning and tone appropriate to the overall message. "
-                + "Pay attention to how the lines relate to one another to maintain consistency, flow, and coherence."
-                + "You MUST respond with a JSON object containing a single key, 'rephrased_lines', which is a list of the rephrased strings. "
-                + "The output list should have the exact same number of items, in the same order, as the input list."
-            )
-
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": input_json_str}
-            ]
-            
-            response = openai.chat.completions.create(
-                model=settings.get('model', 'gpt-3.5-turbo'),
-                messages=messages,
-                max_tokens=1024, # Increased max_tokens for JSON overhead
-                temperature=0.7,
-                timeout=20.0, # Increased timeout for potentially longer processing
-                # response_format={"type": "json_object"} # Ideal, but might not be supported by all endpoints
-            )
-            
-            reply_content = response.choices[0].message.content.strip()
-            debug_print('[DEBUG] Raw OpenAI response:\n', reply_content)
-
-            # Extract JSON from the reply, which might be wrapped in markdown
-            match = re.search(r"\{.*\}", reply_content, re.DOTALL)
-            if match:
-                json_str = match.group(0)
-            else:
-                self.result_ready.emit(f"Error: Model did not return valid JSON.\n\n{reply_content}", True)
+            # Lines unchanged since a recent selection keep their earlier rephrasing,
+            # unless the model or prompt changed since. Very large selections
+            # skip session memory so it cannot pin them.
+            session_context = (settings.get('model', 'gpt-3.5-turbo'), system_prompt_info[0])
+            use_session = len(normalized_text) <= SESSION_MAX_SELECTION_CHARS
+            rephrased_map = rephrase_session.reuse(session_context, line_hashes) if use_session else {}
+            changed_indices = array('l', (idx for idx in rephrasable_indices if idx not in rephrased_map))
+            if DEBUG:
+                debug_print(f'[DEBUG] Reusing {len(rephrased_map)} lines, sending {len(changed_indices)} changed lines')
+            if not changed_indices:
+                usage_ledger.record(self.get_source_exe(), settings.get('model', 'gpt-3.5-turbo'), 0, 0, 0, None, True)
+                rephrase_session.remember(session_context, line_hashes, rephrased_map)
+                self.result_ready.emit(self.reconstruct(normalized_text, line_starts, rephrased_map), False)
                 return
 
-            try:
-                response_data = json.loads(json_str)
-                rephrased_lines = response_data.get("rephrased_lines", [])
-            except json.JSONDecodeError:
-                self.result_ready.emit(f"Error: Failed to decode JSON from model response.\n\n{reply_content}", True)
-                return
-
-            # Clean up rephrased lines - remove any \r characters and ensure proper line structure
-            if isinstance(rephrased_lines, list):
-                cleaned_rephrased_lines = []
-                for line in rephrased_lines:
-                    if isinstance(line, str):
-                        # Remove \r characters and split on \n if the API combined lines
-                        cleaned_line = line.replace('\r', '').strip()
-                        # If a line contains \n, it means the API combined multiple lines
-                        if '\n' in cleaned_line:
-                            cleaned_rephrased_lines.extend([l.strip() for l in cleaned_line.split('\n') if l.strip()])
-                        else:
-                            cleaned_rephrased_lines.append(cleaned_line)
-                rephrased_lines = cleaned_rephrased_lines
-
-            debug_print(f'[DEBUG] Cleaned rephrased lines count: {len(rephrased_lines)}')
-            debug_print(f'[DEBUG] Expected lines count: {len(lines_to_send)}')
-
-            if not isinstance(rephrased_lines, list):
-                error_msg = "Error: Rephrased data is not a valid list."
-                debug_print(f'[DEBUG] Rephrased lines: {rephrased_lines}')
-                self.result_ready.emit(f"{error_msg}\n\n{reply_content}", True)
-                return
-            
-            # Handle mismatched line counts by padding or truncating as needed
-            if len(rephrased_lines) != len(lines_to_send):
+            lines_to_send = [self.line_at(normalized_text, line_starts, idx) for idx in changed_indices]
+            if DEBUG:
+                debug_print(f'[DEBUG] Total lines: {line_count}, Lines to rephrase: {len(lines_to_send)}')
+                debug_print(f'[DEBUG] Lines to rephrase indices: {list(changed_indices)}')
+            context = None
+            if rephrased_map:
+                # Neighbouring lines that are not resent give the model read-only context
+                changed_set = set(changed_indices)
+                context_indices = sorted({
+                    neighbour
+                    for idx in changed_indices
+                    for neighbour in (idx - 1, idx + 1)
+                    if 0 <= neighbour < line_count and neighbour not in changed_set
+                })
+                context = [self.line_at(normalized_text, line_starts, idx) for idx in context_indices]
+                context = [line for line in context if line.strip()]
+
+            rephrased_lines, error_msg, reply_content = self.request_rephrasing(lines_to_send, context, bool(rephrased_map))
+            if rephrased_lines is None or len(rephrased_lines) < len(lines_to_send):
+                # One automatic repair round, limited to the lines that came back broken or missing
+                answered = rephrased_lines or []
+                if DEBUG:
+                    debug_print(f'[DEBUG] Repairing {len(lines_to_send) - len(answered)} of {len(lines_to_send)} lines')
+                try:
+                    repaired, _, _ = self.request_rephrasing(lines_to_send[len(answered):], context, bool(rephrased_map))
+                except Exception as e:
+                    # A failed repair must not discard the lines the first reply answered
+                    debug_print('[DEBUG] Repair request failed:', e)
+                    repaired = None
+                if repaired is not None:
+                    rephrased_lines = answered + repaired
+                elif rephrased_lines is None:
+                    self.result_ready.emit(f"{error_msg}\n\n{reply_content}", True)
+                    return
+
+            # Lines the model did not answer keep their original text, and extra
+            # lines are dropped. Unanswered lines are not remembered, so a retry
+            # sends them again.
+            if len(rephrased_lines) != len(lines_to_send) and DEBUG:
                 debug_print(f'[DEBUG] Line count mismatch: got {len(rephrased_lines)}, expected {len(lines_to_send)}')
                 debug_print(f'[DEBUG] Rephrased lines: {rephrased_lines}')
                 debug_print(f'[DEBUG] Lines to send: {lines_to_send}')
-                
-                if len(rephrased_lines) < len(lines_to_send):
-                    # If we have fewer rephrased lines, pad with original lines
-                    missing_count = len(lines_to_send) - len(rephrased_lines)
-                    debug_print(f'[DEBUG] Padding with {missing_count} original lines')
-                    # Add the missing original lines at the end
-                    rephrased_lines.extend(lines_to_send[-missing_count:])
-                elif len(rephrased_lines) > len(lines_to_send):
-                    # If we have too many rephrased lines, truncate
-                    debug_print(f'[DEBUG] Truncating {len(rephrased_lines) - len(lines_to_send)} extra lines')
-                    rephrased_lines = rephrased_lines[:len(lines_to_send)]
-
-            # Reconstruct the text
-            rephrased_lines_iter = iter(rephrased_lines)
-            debug_print('[DEBUG] rephrased_lines_iter: ', rephrased_lines_iter)
-            for index in lines_to_rephrase_map.keys():
-                try:
-                    rephrased_line = next(rephrased_lines_iter)
-                    debug_print('[DEBUG] reconstructed_lines[index]: ', reconstructed_lines[index])
-                    debug_print('[DEBUG] rephrased_line: ', rephrased_line)
-                    reconstructed_lines[index] = rephrased_line
-                except StopIteration:
-                    debug_print(f"[DEBUG] StopIteration at index {index}. Mismatch between lines to rephrase and rephrased lines.")
-                    break
+            for index, rephrased_line in zip(changed_indices, rephrased_lines):
+                rephrased_map[index] = rephrased_line
+            del lines_to_send, rephrased_lines
 
-            final_text = '\n'.join(reconstructed_lines)
+            if use_session:
+                rephrase_session.remember(session_context, line_hashes, rephrased_map)
+            final_text = self.reconstruct(normalized_text, line_starts, rephrased_map)
             self.result_ready.emit(final_text, False)
 
         except Exception as e:
             debug_print('[DEBUG] error', e)
             self.result_ready.emit(f"Error: {str(e)}", True)
 
+    def request_rephrasing(self, lines_to_send, context, reused_lines):
+        # Returns (rephrased lines or None, error message, raw reply)
+        request_data = {"lines_to_rephrase": lines_to_send}
+        if context:
+            request_data = {"context": context, "lines_to_rephrase": lines_to_send}
+        system_prompt, system_prompt_tokens = system_prompt_info
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(request_data)}
+        ]
+
+        request_started = time.perf_counter()
+        response, response_format = self.create_completion(messages)
+        del messages
+
+        latency_ms = (time.perf_counter() - request_started) * 1000
+        if response.usage is not None:
+            # Recorded under the configured model name, which token_prices is keyed by,
+            # rather than the snapshot name the API reports. cache_hit records whether
+            # session memory spared any lines from being resent.
+            usage_ledger.record(
+                self.get_source_exe(), settings.get('model', 'gpt-3.5-turbo'),
+                response.usage.prompt_tokens, response.usage.completion_tokens,
+                get_cached_tokens(response.usage), latency_ms, reused_lines
+            )
+        if DEBUG and response.usage is not None:
+            cached_tokens = get_cached_tokens(response.usage)
+            debug_print(
+                f'[DEBUG] Request latency: {latency_ms:.0f} ms, '
+                f'prompt tokens: {response.usage.prompt_tokens} (system prompt ~{system_prompt_tokens}), '
+                f'cached tokens saved: {cached_tokens}, completion tokens: {response.usage.completion_tokens}'
+            )
+        reply_content = (response.choices[0].message.content or '').strip()
+        debug_print('[DEBUG] Raw OpenAI response:\n', reply_content)
+        rephrased_lines, error_msg = self.parse_reply(reply_content, response_format != 'text')
+        return rephrased_lines, error_msg, reply_content
+
+    def create_completion(self, messages):
+        # Uses the structured output mode known for this endpoint and model, or
+        # negotiates it on the first request by falling back on rejection.
+        api_url = settings['api_url']
+        model = settings.get('model', 'gpt-3.5-turbo')
+        known = response_format_cache.get(api_url, model)
+        candidates = [known] if known else list(RESPONSE_FORMATS)
+        for response_format in candidates:
+            extra_args = {}
+            if RESPONSE_FORMATS[response_format] is not None:
+                extra_args['response_format'] = RESPONSE_FORMATS[response_format]
+            recorder.record('api_request', model=model, response_format=response_format, messages=messages)
+            request_started = time.perf_counter()
+            try:
+                response = openai.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=1024, # Increased max_tokens for JSON overhead
+                    temperature=0.7,
+                    timeout=20.0, # Increased timeout for potentially longer processing
+                    **extra_args
+                )
+            except openai.BadRequestError as e:
+                recorder.record('api_error', bad_request=True, message=str(e),
+                                latency_ms=(time.perf_counter() - request_started) * 1000)
+                if response_format == candidates[-1] or not is_response_format_error(e):
+                    raise
+                debug_print(f'[DEBUG] {response_format} output rejected, falling back:', e)
+                continue
+            except Exception as e:
+                recorder.record('api_error', bad_request=False, message=str(e),
+                                latency_ms=(time.perf_counter() - request_started) * 1000)
+                raise
+            if recorder.enabled:
+                usage = response.usage
+                recorder.record(
+                    'api_response',
+                    model=response.model,
+                    content=response.choices[0].message.content,
+                    prompt_tokens=usage.prompt_tokens if usage else None,
+                    completion_tokens=usage.completion_tokens if usage else None,
+                    cached_tokens=get_cached_tokens(usage) if usage else None,
+                    latency_ms=(time.perf_counter() - request_started) * 1000
+                )
+            if not known:
+                response_format_cache.remember(api_url, model, response_format)
+            return response, response_format
+
+    def parse_reply(self, reply_content, structured):
+        # Returns (cleaned rephrased lines, None) or (None, error message)
+        response_data = None
+        if structured:
+            # Structured replies are plain JSON; the extraction below is only a fallback
+            try:
+                response_data = json.loads(reply_content)
+            except json.JSONDecodeError:
+                debug_print('[DEBUG] Structured reply was not valid JSON, trying tolerant parsing.')
+        if response_data is None:
+            # Extract JSON from the reply, which might be wrapped in markdown
+            match = re.search(r"\{.*\}", reply_content, re.DOTALL)
+            if not match:
+                return None, "Error: Model did not return valid JSON."
+            try:
+                response_data = json.loads(match.group(0))
+            except json.JSONDecodeError:
+                return None, "Error: Failed to decode JSON from model response."
+
+        rephrased_lines = response_data.get("rephrased_lines", []) if isinstance(response_data, dict) else None
+        if not isinstance(rephrased_lines, list):
+            if DEBUG:
+                debug_print(f'[DEBUG] Rephrased lines: {rephrased_lines}')
+            return None, "Error: Rephrased data is not a valid list."
+
+        # Clean up rephrased lines - remove any \r characters and ensure proper line structure
+        cleaned_rephrased_lines = []
+        for line in rephrased_lines:
+            if isinstance(line, str):
+                # Remove \r characters and split on \n if the API combined lines
+                cleaned_line = line.replace('\r', '').strip()
+                # If a line contains \n, it means the API combined multiple lines
+                if '\n' in cleaned_line:
+                    cleaned_rephrased_lines.extend([l.strip() for l in cleaned_line.split('\n') if l.strip()])
+                else:
+                    cleaned_rephrased_lines.append(cleaned_line)
+        return cleaned_rephrased_lines, None
+
+    def get_source_exe(self):
+        try:
+            return get_window_exe(self.source_hwnd) if self.source_hwnd else 'unknown'
+        except Exception as e:
+            debug_print('[DEBUG] Could not resolve source app:', e)
+            return 'unknown'
+
+    def find_line_starts(self, text):
+        # Offsets where each line starts, plus a sentinel one past the end of the text
+        starts = array('q', [0])
+        pos = text.find('\n')
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = text.find('\n', pos + 1)
+        starts.append(len(text) + 1)
+        return starts
+
+    def line_at(self, text, line_starts, index):
+        return text[line_starts[index]:line_starts[index + 1] - 1]
+
+    def reconstruct(self, text, line_starts, replacements):
+        # Copies the untouched spans of the text and the replaced lines into one buffer
+        output = io.StringIO()
+        pos = 0
+        for index in sorted(replacements):
+            output.write(text[pos:line_starts[index]])
+            output.write(replacements[index])
+            pos = line_starts[index + 1] - 1
+        output.write(text[pos:])
+        return output.getvalue()
+
+    def is_rephrasable(self, line):
+        # Only rephrase lines that have actual content (not just whitespace)
+        # and are not comments or code-like
+        stripped = line.strip()
+        return bool(stripped) and not (
+            stripped.startswith('#') or
+            stripped.startswith('%') or
+            self.is_code_like(line)
+        )
+
     def is_code_like(self, line):
         stripped = line.strip()
         return (
@@ -304,28 +854,52 @@ class RephraseWorker(QtCore.QThread):
         )
 
 class RephraseOverlay(QtWidgets.QWidget):
-    def __init__(self, selected_text, source_hwnd, parent=None):
+    closed = QtCore.pyqtSignal()
+
+    def __init__(self, parent=None):
         super().__init__(parent)
-        self.selected_text = selected_text
+        self.selected_text = ''
         self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint | QtCore.Qt.Tool)
         self.setAttribute(QtCore.Qt.WA_TranslucentBackground)
-        self.prev_hwnd = source_hwnd
+        self.prev_hwnd = None
+        self.worker = None
+        self.result_text = ''
+        self.pending_chunks = []
+        self.line_widths = {}
+        self.line_widths_font = None
+        self.append_timer = QtCore.QTimer(self)
+        self.append_timer.setSingleShot(True)
+        self.append_timer.setInterval(0)
+        self.append_timer.timeout.connect(self.append_next_chunk)
         self.init_ui()
-        self.get_rephrased_text()
-        # Fade effect
+        # Fade effect; both animations are built once and replayed on every show
         self.opacity_effect = QtWidgets.QGraphicsOpacityEffect(self)
         self.setGraphicsEffect(self.opacity_effect)
-        self.fade_anim = QtCore.QPropertyAnimation(self.opacity_effect, b"opacity")
-        self.fade_anim.setDuration(300)
-        self.fade_anim.setStartValue(0)
-        self.fade_anim.setEndValue(1)
-        self.fade_anim.start()
-        # Auto-close timer (10 seconds, always starts on show)
+        self.fade_in_anim = QtCore.QPropertyAnimation(self.opacity_effect, b"opacity")
+        self.fade_in_anim.setDuration(300)
+        self.fade_in_anim.setStartValue(0)
+        self.fade_in_anim.setEndValue(1)
+        self.fade_out_anim = QtCore.QPropertyAnimation(self.opacity_effect, b"opacity")
+        self.fade_out_anim.setDuration(400)
+        self.fade_out_anim.setEndValue(0)
+        self.fade_out_anim.finished.connect(self.close)
+        # Auto-close timer (10 seconds, restarted by start())
         self.auto_close_timer = QtCore.QTimer(self)
         self.auto_close_timer.setSingleShot(True)
         self.auto_close_timer.timeout.connect(self.on_auto_close_timeout)
         self.setMouseTracking(True)
         self.timer_expired = False
+
+    def start(self, selected_text, source_hwnd):
+        # Reset a pooled overlay for a new selection and request its rephrasing
+        self.selected_text = selected_text
+        self.prev_hwnd = source_hwnd
+        self.timer_expired = False
+        recorder.record('overlay', event='start', chars=len(selected_text))
+        self.fade_out_anim.stop()
+        self.set_result_text('')
+        self.text_view.setStyleSheet("background: transparent; font-size: 14px;")
+        self.get_rephrased_text()
         self.auto_close_timer.start(10000)
 
     def on_auto_close_timeout(self):
@@ -343,27 +917,34 @@ class RephraseOverlay(QtWidgets.QWidget):
         super().leaveEvent(event)
 
     def fade_and_close(self):
-        self.fade_anim = QtCore.QPropertyAnimation(self.opacity_effect, b"opacity")
-        self.fade_anim.setDuration(400)
-        self.fade_anim.setStartValue(1)
-        self.fade_anim.setEndValue(0)
-        self.fade_anim.finished.connect(self.close)
-        self.fade_anim.start()
+        if self.fade_out_anim.state() == QtCore.QAbstractAnimation.Running:
+            return
+        self.fade_in_anim.stop()
+        self.fade_out_anim.setStartValue(self.opacity_effect.opacity())
+        self.fade_out_anim.start()
 
     def showEvent(self, event):
         # Fade in when shown
+        self.fade_out_anim.stop()
         self.opacity_effect.setOpacity(0)
-        self.fade_anim = QtCore.QPropertyAnimation(self.opacity_effect, b"opacity")
-        self.fade_anim.setDuration(300)
-        self.fade_anim.setStartValue(0)
-        self.fade_anim.setEndValue(1)
-        self.fade_anim.start()
+        self.fade_in_anim.start()
         super().showEvent(event)
 
     def closeEvent(self, event):
+        recorder.record('overlay', event='close')
         self.auto_close_timer.stop()
+        self.append_timer.stop()
+        # A result arriving after the overlay closed must not show it again
+        self.release_worker()
+        # The widget stays pooled, so let go of the selection and its result
+        self.selected_text = ''
+        self.result_text = ''
+        self.pending_chunks = []
+        self.line_widths.clear()
+        self.text_view.clear()
         QtCore.QTimer.singleShot(100, self.clear_clipboard)
         super().closeEvent(event)
+        self.closed.emit()
 
     def clear_clipboard(self):
         try:
@@ -392,13 +973,21 @@ class RephraseOverlay(QtWidgets.QWidget):
         close_btn.clicked.connect(self.close)
         close_layout.addWidget(close_btn)
         frame_layout.addLayout(close_layout)
-        self.text_label = QtWidgets.QLabel()
-        self.text_label.setWordWrap(True)
-        self.text_label.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
-        self.text_label.setStyleSheet("background: transparent; font-size: 14px; padding: 0px;")
-        self.text_label.setSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Minimum)
-        self.text_label.installEventFilter(self)
-        frame_layout.addWidget(self.text_label, alignment=QtCore.Qt.AlignTop)
+        # A read-only QPlainTextEdit only lays out the blocks that are visible,
+        # so very large results scroll instead of re-wrapping the whole text.
+        self.text_view = QtWidgets.QPlainTextEdit()
+        self.text_view.setReadOnly(True)
+        # Appended chunks would otherwise pile up on the undo stack
+        self.text_view.setUndoRedoEnabled(False)
+        self.text_view.setFrameStyle(QtWidgets.QFrame.NoFrame)
+        self.text_view.setLineWrapMode(QtWidgets.QPlainTextEdit.WidgetWidth)
+        self.text_view.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.text_view.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAsNeeded)
+        self.text_view.setTextInteractionFlags(QtCore.Qt.NoTextInteraction)
+        self.text_view.setStyleSheet("background: transparent; font-size: 14px; padding: 0px;")
+        self.text_view.setSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Expanding)
+        self.text_view.viewport().installEventFilter(self)
+        frame_layout.addWidget(self.text_view)
         self.instruction_label = QtWidgets.QLabel('(Click on the green area to replace the selected text).')
         self.instruction_label.setAlignment(QtCore.Qt.AlignCenter)
         self.instruction_label.setStyleSheet('color: #666; font-size: 11px; padding-top: 8px; background: transparent;')
@@ -414,48 +1003,126 @@ class RephraseOverlay(QtWidgets.QWidget):
         self.setMaximumSize(1200, 800)
 
     def get_rephrased_text(self):
-        self.text_label.hide()
+        self.text_view.hide()
         self.instruction_label.hide()
         self.loading_label.show()
-        self.worker = RephraseWorker(self.selected_text)
+        # A pooled overlay must ignore results still pending for its previous selection
+        self.release_worker()
+        self.worker = RephraseWorker(self.selected_text, self.prev_hwnd)
         self.worker.result_ready.connect(self.on_result_ready)
         self.worker.start()
 
+    def release_worker(self):
+        if self.worker is None:
+            return
+        try:
+            self.worker.result_ready.disconnect(self.on_result_ready)
+        except (TypeError, RuntimeError):
+            pass  # already disconnected, or the finished worker was deleted
+        self.worker = None
+
     def on_result_ready(self, result, is_error):
-        debug_print('[DEBUG] on_result_ready called with:', repr(result), 'is_error:', is_error)
+        if self.sender() is not self.worker:
+            return  # queued before the worker was released
+        if DEBUG:
+            debug_print('[DEBUG] on_result_ready called with:', repr(result), 'is_error:', is_error)
+        # The worker deletes itself once it finishes, so drop the reference now
+        self.worker = None
         # Always clean tags before display
         if isinstance(result, str):
             result = re.sub(r"\[\[REPHRASE:\s*\d+\]\]\s*", "", result, flags=re.IGNORECASE | re.MULTILINE)
         self.loading_label.hide()
+        recorder.record('overlay', event='result', is_error=is_error, chars=len(result))
         if is_error:
-            debug_print('[DEBUG] Setting error text in label:', repr(result))
-            self.text_label.setText(result)
-            self.text_label.setStyleSheet("background: #ffe0e0; padding: 8px; border-radius: 16px; font-size: 14px;")
+            if DEBUG:
+                debug_print('[DEBUG] Setting error text in view:', repr(result))
+            self.text_view.setStyleSheet("background: #ffe0e0; padding: 8px; border-radius: 16px; font-size: 14px;")
         else:
-            debug_print('[DEBUG] Setting normal text in label:', repr(result))
-            self.text_label.setText(result)
-            self.text_label.setStyleSheet("background: transparent; font-size: 14px;")
-        self.text_label.show()
+            debug_print('[DEBUG] Setting normal text in view.')
+            self.text_view.setStyleSheet("background: transparent; font-size: 14px;")
+        self.set_result_text(result)
+        self.text_view.show()
         self.instruction_label.show()
         self.adjust_size_to_text()
         self.show()
         self.raise_()
         self.activateWindow()
 
+    def set_result_text(self, text):
+        # Keep the full result around for copying, and feed the view in chunks
+        # so the first screenful is painted before the rest is appended.
+        self.result_text = text
+        self.pending_chunks = []
+        self.append_timer.stop()
+        self.text_view.clear()
+        if text.count('\n') < RESULT_CHUNK_LINES:
+            self.text_view.setPlainText(text)
+            return
+        lines = text.split('\n')
+        self.pending_chunks = [
+            '\n'.join(lines[i:i + RESULT_CHUNK_LINES])
+            for i in range(0, len(lines), RESULT_CHUNK_LINES)
+        ]
+        self.pending_chunks.reverse()
+        self.append_next_chunk()
+
+    def append_next_chunk(self):
+        if not self.pending_chunks:
+            return
+        chunk = self.pending_chunks.pop()
+        cursor = QtGui.QTextCursor(self.text_view.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        if not self.text_view.document().isEmpty():
+            chunk = '\n' + chunk
+        # Inserting through a separate cursor leaves the view scrolled to the top
+        cursor.insertText(chunk)
+        if self.pending_chunks:
+            self.append_timer.start()
+
+    def measure_line(self, metrics, line):
+        width = self.line_widths.get(line)
+        if width is None:
+            width = metrics.width(line)
+            self.line_widths[line] = width
+        return width
+
     def adjust_size_to_text(self):
-        font = self.text_label.font()
+        self.text_view.ensurePolished()
+        font = self.text_view.font()
+        if font.key() != self.line_widths_font:
+            self.line_widths.clear()
+            self.line_widths_font = font.key()
         metrics = QtGui.QFontMetrics(font)
-        lines = self.text_label.text().splitlines() or ['']
-        max_line_width = max((metrics.width(line) for line in lines), default=200)
-        width = max(max_line_width + 40, 200)
-        content_height = max(metrics.height() * len(lines) + 40, 60)
-        self.resize(width, content_height)
+        screen = QtWidgets.QApplication.screenAt(QtGui.QCursor.pos()) or QtWidgets.QApplication.primaryScreen()
+        available = screen.availableGeometry()
+        max_width = min(self.maximumWidth(), available.width() - 2 * OVERLAY_SCREEN_MARGIN)
+        max_height = min(self.maximumHeight(), available.height() - 2 * OVERLAY_SCREEN_MARGIN)
+        line_height = metrics.lineSpacing()
+        visible_lines = max(1, (max_height - OVERLAY_CHROME_HEIGHT) // line_height)
+
+        # Only the lines that can fit on screen are measured; the rest scroll.
+        text = self.result_text
+        total_lines = text.count('\n') + 1
+        max_line_width = 0
+        pos = 0
+        for _ in range(min(total_lines, visible_lines)):
+            end = text.find('\n', pos)
+            line = text[pos:] if end == -1 else text[pos:end]
+            max_line_width = max(max_line_width, self.measure_line(metrics, line))
+            if max_line_width + OVERLAY_CHROME_WIDTH >= max_width or end == -1:
+                break
+            pos = end + 1
+        width = min(max(max_line_width + OVERLAY_CHROME_WIDTH, 200), max_width)
+        content_height = line_height * min(total_lines, visible_lines) + OVERLAY_CHROME_HEIGHT
+        height = min(max(content_height, 60), max_height)
+        self.resize(width, height)
 
     def eventFilter(self, obj, event):
-        if obj == self.text_label and event.type() == QtCore.QEvent.MouseButtonPress:
+        if obj == self.text_view.viewport() and event.type() == QtCore.QEvent.MouseButtonPress:
             if hasattr(self, 'auto_close_timer'):
                 self.auto_close_timer.stop()
-            rephrased = self.text_label.text()
+            rephrased = self.result_text
+            recorder.record('overlay', event='paste')
             pyperclip.copy('')
             time.sleep(0.05)
             pyperclip.copy(rephrased)
@@ -469,14 +1136,12 @@ class RephraseOverlay(QtWidgets.QWidget):
                     time.sleep(0.1)
                 keyboard.press_and_release('ctrl+v')
                 debug_print('[DEBUG] Pasted rephrased text.')
-                notif = NotificationWindow('Rephrased text has been pasted.')
-                notif.show()
+                notification_pool.acquire().show_message('Rephrased text has been pasted.')
                 time.sleep(0.1)
                 pyperclip.copy('')
             except Exception as e:
                 debug_print(f'[DEBUG] Failed to paste: {e}')
-                notif = NotificationWindow('Rephrased text copied!<br>Could not paste automatically.')
-                notif.show()
+                notification_pool.acquire().show_message('Rephrased text copied!<br>Could not paste automatically.')
             return True
         return super().eventFilter(obj, event)
 
@@ -500,6 +1165,12 @@ class SelectionListener(QtCore.QObject):
 
 
     def trigger_rephrase(self):
+        if recorder.enabled:
+            try:
+                exe = get_window_exe(win32gui.GetForegroundWindow())
+            except Exception:
+                exe = ''
+            recorder.record('trigger', exe=exe)
         if not is_supported_app_focused():
             debug_print('[DEBUG] Hotkey triggered, but not a supported app.')
             return
@@ -520,6 +1191,10 @@ class SelectionListener(QtCore.QObject):
             text = pyperclip.paste()
         except Exception as e:
             debug_print(f"[DEBUG] Could not paste: {e}")
+        # When the copy changed nothing, text is still the previous clipboard, which may be
+        # unrelated to the app (a password, say), so only the change itself is recorded
+        changed = text != old_clip
+        recorder.record('clipboard', changed=changed, copied=text if changed else '')
 
         if text and text != old_clip:
             debug_print('[DEBUG] Hotkey pressed, showing rephrase overlay for:', text[:50])
@@ -560,16 +1235,25 @@ class SelectionListener(QtCore.QObject):
         
 
     def show_rephrase_overlay(self, text, source_hwnd):
-        debug_print('[DEBUG] show_rephrase_overlay called with:', repr(text))
+        if DEBUG:
+            debug_print('[DEBUG] show_rephrase_overlay called with:', repr(text))
         if self.overlay is not None:
             try:
                 self.overlay.close()
             except Exception as e:
                 debug_print('[DEBUG] Error closing previous overlay:', e)
             self.overlay = None
-        self.overlay = RephraseOverlay(text, source_hwnd)
+        self.overlay = overlay_pool.acquire()
+        self.overlay.closed.connect(self.on_overlay_closed)
+        self.overlay.start(text, source_hwnd)
         self.overlay.show_near_cursor()
 
+    def on_overlay_closed(self):
+        overlay = self.sender()
+        overlay.closed.disconnect(self.on_overlay_closed)
+        if overlay is self.overlay:
+            self.overlay = None
+
 def get_startup_shortcut_path():
     startup_dir = os.path.join(os.environ['APPDATA'], r'Microsoft\Windows\Start Menu\Programs\Startup')
     if getattr(sys, 'frozen', False):
@@ -610,22 +1294,30 @@ def is_startup_enabled():
     shortcut_path, _, _, _ = get_startup_shortcut_path()
     return os.path.exists(shortcut_path)
 
-class ModelFetchWorker(QtCore.QThread):
-    models_ready = QtCore.pyqtSignal(list, str)
+class ModelFetchWorker(ManagedThread):
+    models_ready = QtCore.pyqtSignal(list, str, str)
 
-    def __init__(self, api_key, api_url):
+    def __init__(self, api_key, api_url, model=''):
         super().__init__()
         self.api_key = api_key
         self.api_url = api_url
+        self.model = model
 
     def run(self):
         try:
             client = openai.OpenAI(api_key=self.api_key, base_url=self.api_url)
             models = client.models.list()
             model_ids = sorted([model.id for model in models.data])
-            self.models_ready.emit(model_ids, "")
+            # Probe the selected model's structured output support alongside the list
+            response_format = ''
+            if self.model in model_ids:
+                try:
+                    response_format = probe_response_format(client, self.model)
+                except Exception as e:
+                    debug_print('[DEBUG] Response format probe failed:', e)
+            self.models_ready.emit(model_ids, response_format, "")
         except Exception as e:
-            self.models_ready.emit([], str(e))
+            self.models_ready.emit([], "", str(e))
 
 class SettingsWindow(QtWidgets.QMainWindow):
     PREDEFINED_APPS = {
@@ -641,7 +1333,7 @@ class SettingsWindow(QtWidgets.QMainWindow):
         super().__init__(parent)
         self.setWindowTitle('Settings')
         self.setMinimumSize(450, 400)
-        self.setWindowIcon(QtGui.QIcon(get_icon_path()))
+        self.setWindowIcon(get_app_icon())
         self.tabs = QtWidgets.QTabWidget()
         self.general_tab = QtWidgets.QWidget()
         self.parameters_tab = QtWidgets.QWidget()
@@ -663,6 +1355,8 @@ class SettingsWindow(QtWidgets.QMainWindow):
         self.setCentralWidget(container)
         self.load_current_settings()
         self.worker = None
+        self.probe_target = None
+        self.probed_formats = {}
 
     def init_general_tab(self):
         layout = QtWidgets.QVBoxLayout()
@@ -704,17 +1398,22 @@ class SettingsWindow(QtWidgets.QMainWindow):
         self.fetch_models_btn.setText("Fetching...")
         self.fetch_models_btn.setEnabled(False)
         
-        self.worker = ModelFetchWorker(api_key, api_url)
+        self.probe_target = (api_url, self.model_combo.currentText())
+        self.worker = ModelFetchWorker(api_key, api_url, self.probe_target[1])
         self.worker.models_ready.connect(self.on_models_fetched)
         self.worker.start()
 
-    def on_models_fetched(self, models, error_str):
+    def on_models_fetched(self, models, response_format, error_str):
+        self.worker = None
         self.fetch_models_btn.setText("Fetch Models")
         self.fetch_models_btn.setEnabled(True)
         
         if error_str:
             QtWidgets.QMessageBox.critical(self, "Error", f"Failed to fetch models:\n{error_str}")
             return
+
+        if response_format:
+            self.probed_formats[response_format_key(*self.probe_target)] = response_format
         
         self.model_combo.clear()
         self.model_combo.addItems(models)
@@ -764,6 +1463,7 @@ class SettingsWindow(QtWidgets.QMainWindow):
             if checkbox.isChecked():
                 enabled_apps.append(exe_name)
         settings['supported_apps'] = enabled_apps
+        settings['response_formats'] = {**settings.get('response_formats', {}), **self.probed_formats}
         
         save_settings()
         
@@ -779,20 +1479,137 @@ class SettingsWindow(QtWidgets.QMainWindow):
                 debug_print('[DEBUG] Failed to disable startup:', e)
         self.close()
 
+class UsageSummaryWindow(QtWidgets.QMainWindow):
+    COLUMNS = [
+        'Requests', 'Prompt Tokens', 'Cached Tokens', 'Completion Tokens', 'Cache Hits', 'Spend', 'p50 Latency',
+        'p95 Latency'
+    ]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Usage Summary')
+        self.setMinimumSize(700, 350)
+        self.setWindowIcon(get_app_icon())
+        self.tabs = QtWidgets.QTabWidget()
+        self.app_table = self.create_table('Application')
+        self.model_table = self.create_table('Model')
+        self.tabs.addTab(self.app_table, 'By Application')
+        self.tabs.addTab(self.model_table, 'By Model')
+        btn_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Close)
+        refresh_btn = btn_box.addButton('Refresh', QtWidgets.QDialogButtonBox.ActionRole)
+        refresh_btn.clicked.connect(self.load_summary)
+        btn_box.rejected.connect(self.close)
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.tabs)
+        layout.addWidget(btn_box)
+        container = QtWidgets.QWidget()
+        container.setLayout(layout)
+        self.setCentralWidget(container)
+        self.load_summary()
+
+    def create_table(self, key_header):
+        table = QtWidgets.QTableWidget(0, len(self.COLUMNS) + 1)
+        table.setHorizontalHeaderLabels([key_header] + self.COLUMNS)
+        table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        table.verticalHeader().setVisible(False)
+        table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+        return table
+
+    def load_summary(self):
+        try:
+            self.fill_table(self.app_table, usage_ledger.summary('app'))
+            self.fill_table(self.model_table, usage_ledger.summary('model'))
+        except Exception as e:
+            QtWidgets.QMessageBox.critical(self, "Error", f"Failed to load usage:\n{e}")
+
+    def fill_table(self, table, rows):
+        table.setRowCount(len(rows))
+        for row_idx, row in enumerate(rows):
+            key, requests, prompt_tokens, cached_tokens, completion_tokens, cache_hits, spend, p50, p95 = row
+            values = [
+                key, str(requests), str(prompt_tokens), str(cached_tokens), str(completion_tokens), str(cache_hits),
+                f'${spend:.4f}',
+                f'{p50:.0f} ms' if p50 is not None else '-',
+                f'{p95:.0f} ms' if p95 is not None else '-',
+            ]
+            for col_idx, value in enumerate(values):
+                table.setItem(row_idx, col_idx, QtWidgets.QTableWidgetItem(value))
+
+class DiagnosticsWindow(QtWidgets.QMainWindow):
+    baseline_snapshot = None  # shared so comparisons survive reopening the window
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Diagnostics')
+        self.setMinimumSize(700, 450)
+        self.setWindowIcon(get_app_icon())
+        self.report_view = QtWidgets.QPlainTextEdit()
+        self.report_view.setReadOnly(True)
+        self.report_view.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        btn_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Close)
+        snapshot_btn = btn_box.addButton('Take Snapshot', QtWidgets.QDialogButtonBox.ActionRole)
+        snapshot_btn.clicked.connect(self.take_snapshot)
+        stop_btn = btn_box.addButton('Stop Tracing', QtWidgets.QDialogButtonBox.ActionRole)
+        stop_btn.clicked.connect(self.stop_tracing)
+        refresh_btn = btn_box.addButton('Refresh', QtWidgets.QDialogButtonBox.ActionRole)
+        refresh_btn.clicked.connect(self.refresh)
+        btn_box.rejected.connect(self.close)
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.report_view)
+        layout.addWidget(btn_box)
+        container = QtWidgets.QWidget()
+        container.setLayout(layout)
+        self.setCentralWidget(container)
+        self.refresh()
+
+    def refresh(self, extra_lines=()):
+        lines = [f'{name}: {value}' for name, value in collect_diagnostics().items()]
+        if not tracemalloc.is_tracing():
+            lines.append('')
+            lines.append('Memory tracing is off. Take a snapshot to start it and record a baseline.')
+        lines.extend(extra_lines)
+        self.report_view.setPlainText('\n'.join(lines))
+
+    def take_snapshot(self):
+        # The first snapshot starts tracing and becomes the baseline; later ones show growth since then
+        gc.collect()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot()
+        baseline = DiagnosticsWindow.baseline_snapshot
+        if baseline is None:
+            DiagnosticsWindow.baseline_snapshot = snapshot
+            self.refresh(['', 'Baseline snapshot recorded.'])
+            return
+        top_stats = snapshot.compare_to(baseline, 'lineno')[:15]
+        self.refresh(['', 'Top memory growth since the baseline snapshot:'] + [str(stat) for stat in top_stats])
+
+    def stop_tracing(self):
+        # Tracing slows every allocation, so it should not stay on for the rest of the session
+        tracemalloc.stop()
+        DiagnosticsWindow.baseline_snapshot = None
+        self.refresh()
+
 class SystemTrayIcon(QtWidgets.QSystemTrayIcon):
     def __init__(self, app, parent=None):
-        icon = QtGui.QIcon(get_icon_path())
+        icon = get_app_icon()
         super().__init__(icon, parent)
         self.app = app
         self.setToolTip('ChatGPT Rephraser')
         menu = QtWidgets.QMenu(parent)
         settings_action = menu.addAction('Settings')
         settings_action.triggered.connect(self.show_settings)
+        usage_action = menu.addAction('Usage Summary')
+        usage_action.triggered.connect(self.show_usage)
+        diagnostics_action = menu.addAction('Diagnostics')
+        diagnostics_action.triggered.connect(self.show_diagnostics)
         exit_action = menu.addAction('Exit')
         exit_action.triggered.connect(self.exit_app)
         self.setContextMenu(menu)
         self.activated.connect(self.on_activated)
         self.settings_window = None
+        self.usage_window = None
+        self.diagnostics_window = None
         self.show()
 
     def show_settings(self):
@@ -803,9 +1620,27 @@ class SystemTrayIcon(QtWidgets.QSystemTrayIcon):
             self.settings_window.raise_()
             self.settings_window.activateWindow()
 
+    def show_usage(self):
+        if self.usage_window is None or not self.usage_window.isVisible():
+            self.usage_window = UsageSummaryWindow()
+            self.usage_window.show()
+        else:
+            self.usage_window.raise_()
+            self.usage_window.activateWindow()
+
+    def show_diagnostics(self):
+        if self.diagnostics_window is None or not self.diagnostics_window.isVisible():
+            self.diagnostics_window = DiagnosticsWindow()
+            self.diagnostics_window.show()
+        else:
+            self.diagnostics_window.raise_()
+            self.diagnostics_window.activateWindow()
+
     def exit_app(self):
         mouse.unhook_all()
         keyboard.unhook_all()
+        recorder.close()
+        ManagedThread.wait_all()
         QtCore.QCoreApplication.quit()
 
     def on_activated(self, reason):
@@ -813,35 +1648,66 @@ class SystemTrayIcon(QtWidgets.QSystemTrayIcon):
             self.contextMenu().popup(QtGui.QCursor.pos())
 
 class NotificationWindow(QtWidgets.QWidget):
-    def __init__(self, message, duration=2000, parent=None):
+    def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint | QtCore.Qt.Tool)
         self.setAttribute(QtCore.Qt.WA_TranslucentBackground)
         layout = QtWidgets.QVBoxLayout()
-        label = QtWidgets.QLabel(message)
-        label.setStyleSheet("background: #ffffe0; padding: 12px; border-radius: 8px; font-size: 14px; color: #333;")
-        layout.addWidget(label)
+        self.label = QtWidgets.QLabel()
+        self.label.setStyleSheet("background: #ffffe0; padding: 12px; border-radius: 8px; font-size: 14px; color: #333;")
+        layout.addWidget(self.label)
         self.setLayout(layout)
+        self.close_timer = QtCore.QTimer(self)
+        self.close_timer.setSingleShot(True)
+        self.close_timer.timeout.connect(self.close)
+
+    def show_message(self, message, duration=2000):
+        self.label.setText(message)
         self.adjustSize()
         screen = QtWidgets.QApplication.primaryScreen().availableGeometry()
         self.move(screen.center() - self.rect().center())
-        QtCore.QTimer.singleShot(duration, self.close)
+        self.show()
+        self.close_timer.start(duration)
+
+# Pools are filled by main() once the QApplication exists
+overlay_pool = WidgetPool(RephraseOverlay)
+notification_pool = WidgetPool(NotificationWindow)
 
 class DoubleCtrlListener:
-    def __init__(self, callback):
+    # The keyboard hook runs on the system-wide hook thread, so on_ctrl_press
+    # only compares timestamps and enqueues; a dispatcher thread runs the callback.
+    def __init__(self, callback, clock=time.perf_counter):
         self.callback = callback
-        self.last_ctrl_press_time = 0
+        self.clock = clock
+        self.last_ctrl_press_time = float('-inf')
+        self.pending = queue.Queue(maxsize=1)
+        self.dispatcher = threading.Thread(target=self.dispatch, name='DoubleCtrlDispatcher', daemon=True)
+        self.dispatcher.start()
         keyboard.on_press_key("ctrl", self.on_ctrl_press, suppress=False)
 
     def on_ctrl_press(self, key_event):
-        current_time = time.time()
-        if current_time - self.last_ctrl_press_time < 0.3:
-            self.callback()
+        current_time = self.clock()
+        recorder.record('key', key='ctrl')
+        if current_time - self.last_ctrl_press_time < DOUBLE_TAP_MAX_DELAY:
             # Reset the timer to prevent immediate re-triggering
-            self.last_ctrl_press_time = 0
+            self.last_ctrl_press_time = float('-inf')
+            try:
+                self.pending.put_nowait(current_time)
+            except queue.Full:
+                pass  # a trigger is already waiting to be handled
         else:
             self.last_ctrl_press_time = current_time
 
+    def dispatch(self):
+        while True:
+            pressed_at = self.pending.get()
+            if DEBUG:
+                debug_print(f'[DEBUG] Double Ctrl waited {(self.clock() - pressed_at) * 1e6:.0f} us in the queue')
+            try:
+                self.callback()
+            except Exception as e:
+                debug_print('[DEBUG] Double Ctrl callback error:', e)
+
 class GlobalPasteHotkey(QtCore.QObject):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -854,15 +1720,25 @@ class GlobalPasteHotkey(QtCore.QObject):
 def main():
     global hidden_main
     app = QtWidgets.QApplication(sys.argv)
-    app.setWindowIcon(QtGui.QIcon(get_icon_path()))
+    app.setWindowIcon(get_app_icon())
     app.setQuitOnLastWindowClosed(False)
     hidden_main = QtWidgets.QMainWindow()
-    hidden_main.setWindowIcon(QtGui.QIcon(get_icon_path()))
+    hidden_main.setWindowIcon(get_app_icon())
     hidden_main.setWindowTitle('GRephraser')
     hidden_main.setGeometry(-10000, -10000, 100, 100)
     hidden_main.show()
     hidden_main.hide()
+    overlay_pool.prewarm()
+    notification_pool.prewarm()
     tray = SystemTrayIcon(app)
+    recorder.record(
+        'session',
+        model=settings.get('model'),
+        api_url=settings.get('api_url'),
+        supported_apps=settings.get('supported_apps', []),
+        response_formats=settings.get('response_formats', {}),
+        prompt=settings.get('prompt', '')
+    )
     listener = SelectionListener(app)
     paste_hotkey = GlobalPasteHotkey()
     
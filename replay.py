@@ -0,0 +1,565 @@
+"""Headless replayer for sessions captured with REPHRASER_RECORD.
+
+Feeds a recorded replay file back through SelectionListener and RephraseWorker
+on any platform, with the Windows, keyboard, clipboard and OpenAI modules
+replaced by fakes that answer from the recording. Prints the trigger-to-result
+latency of every recorded trigger next to the replayed one.
+
+    python replay.py session.jsonl --speed 4 --fail-over 250
+
+With --soak it instead runs synthetic rephrase cycles, every other one closed
+while still loading, and checks that memory, thread and widget counts stay
+flat and that no closed overlay comes back.
+
+    python replay.py --soak 10000
+
+With --bench it times one part of the app with the same fakes:
+
+    python replay.py --bench hotkey [session.jsonl]
+    python replay.py --bench render
+    python replay.py --bench allocations
+    python replay.py --bench selection
+"""
+import sys
+import os
+import json
+import time
+import types
+import argparse
+import threading
+import gc
+import tracemalloc
+from collections import deque
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.pop('REPHRASER_RECORD', None)
+
+
+class FakeDesktop:
+    """Foreground app and clipboard state the fakes read and write."""
+
+    def __init__(self):
+        self.exe = ''
+        self.clipboard = ''
+        self.copied = ''
+        self.lock = threading.Lock()
+
+    def paste(self):
+        with self.lock:
+            return self.clipboard
+
+    def copy(self, text):
+        with self.lock:
+            self.clipboard = text
+
+    def press_and_release(self, keys):
+        if keys == 'ctrl+c':
+            self.copy(self.copied)
+
+
+class FakeBadRequestError(Exception):
+    pass
+
+
+class FakeCompletions:
+    """Answers chat completions from the recorded API events, in order."""
+
+    def __init__(self, events, speed):
+        self.events = deque(events)
+        self.speed = speed
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self.lock:
+            event = self.events.popleft() if self.events else None
+        if event is None:
+            raise RuntimeError('Replay has no recorded API response left')
+        if self.speed:
+            time.sleep(event.get('latency_ms', 0) / 1000 / self.speed)
+        if event['kind'] == 'api_error':
+            if event.get('bad_request'):
+                raise FakeBadRequestError(event['message'])
+            raise RuntimeError(event['message'])
+        usage = None
+        if event.get('prompt_tokens') is not None:
+            usage = types.SimpleNamespace(
+                prompt_tokens=event['prompt_tokens'],
+                completion_tokens=event['completion_tokens'],
+                prompt_tokens_details=types.SimpleNamespace(cached_tokens=event.get('cached_tokens') or 0)
+            )
+        message = types.SimpleNamespace(content=event.get('content'))
+        return types.SimpleNamespace(
+            model=event.get('model'),
+            choices=[types.SimpleNamespace(message=message)],
+            usage=usage
+        )
+
+
+class SyntheticCompletions:
+    """Answers every chat completion at once by echoing the lines it was sent."""
+
+    def create(self, **kwargs):
+        request = json.loads(kwargs['messages'][-1]['content'])
+        content = json.dumps({'rephrased_lines': [line.upper() for line in request['lines_to_rephrase']]})
+        return types.SimpleNamespace(
+            model=kwargs.get('model'),
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))],
+            usage=None
+        )
+
+
+class MemoryRecorder:
+    """Stands in for main.recorder and keeps the replayed events in memory."""
+
+    enabled = True
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, kind, **data):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.events.append({'t': time.perf_counter() - self.started, 'kind': kind, **data})
+
+    def close(self):
+        pass
+
+
+def install_fakes(desktop, completions):
+    # main imports these at module level, so they must exist before it is imported
+    def module(name, **attrs):
+        fake = types.ModuleType(name)
+        fake.__dict__.update(attrs)
+        sys.modules[name] = fake
+        return fake
+
+    module('win32gui', GetForegroundWindow=lambda: 1, ShowWindow=lambda *args: None,
+           SetForegroundWindow=lambda *args: None)
+    module('win32con', SW_SHOW=5)
+    module('win32process', GetWindowThreadProcessId=lambda hwnd: (0, 0))
+    module('pyperclip', paste=desktop.paste, copy=desktop.copy)
+    module('keyboard', on_press_key=lambda *args, **kwargs: None, press_and_release=desktop.press_and_release,
+           is_pressed=lambda key: False, unhook_all=lambda: None)
+    module('mouse', unhook_all=lambda: None)
+    openai = module('openai', BadRequestError=FakeBadRequestError, api_key='', base_url='',
+                    OpenAI=None)
+    openai.chat = types.SimpleNamespace(completions=completions)
+
+
+def load_events(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def collect_triggers(events):
+    # Each trigger carries the foreground exe and the clipboard it saw. The
+    # previous clipboard is not recorded, so it is made equal to the copied
+    # text exactly when the recorded copy left the clipboard unchanged.
+    triggers = []
+    for event in events:
+        if event['kind'] == 'trigger':
+            triggers.append({'t': event['t'], 'exe': event['exe'], 'before': '', 'copied': ''})
+        elif event['kind'] == 'clipboard' and triggers:
+            triggers[-1]['before'] = '' if event['changed'] else event['copied']
+            triggers[-1]['copied'] = event['copied']
+    return triggers
+
+
+def trigger_latencies(events):
+    # Milliseconds from each trigger to the overlay result it produced, or None
+    latencies = []
+    pending = None
+    for event in events:
+        if event['kind'] == 'trigger':
+            if pending is not None:
+                latencies.append(None)
+            pending = event['t']
+        elif event['kind'] == 'overlay' and event.get('event') == 'result' and pending is not None:
+            latencies.append((event['t'] - pending) * 1000)
+            pending = None
+    if pending is not None:
+        latencies.append(None)
+    return latencies
+
+
+def trigger_api_latencies(events):
+    # Milliseconds each trigger spent waiting on recorded API calls, aligned with trigger_latencies
+    latencies = []
+    pending = None
+    for event in events:
+        if event['kind'] == 'trigger':
+            if pending is not None:
+                latencies.append(pending)
+            pending = 0.0
+        elif event['kind'] in ('api_response', 'api_error') and pending is not None:
+            pending += event.get('latency_ms', 0)
+        elif event['kind'] == 'overlay' and event.get('event') == 'result' and pending is not None:
+            latencies.append(pending)
+            pending = None
+    if pending is not None:
+        latencies.append(pending)
+    return latencies
+
+
+def load_app(desktop, completions, recorder):
+    # Imports main behind the fakes and returns (main, QApplication, SelectionListener)
+    install_fakes(desktop, completions)
+    import main
+    from PyQt5 import QtWidgets
+
+    main.recorder = recorder
+    main.usage_ledger = main.UsageLedger(':memory:')
+    main.save_settings = lambda: None
+    main.get_window_exe = lambda hwnd: desktop.exe
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+    return main, app, main.SelectionListener(app)
+
+
+def replay(events, speed, timeout):
+    desktop = FakeDesktop()
+    completions = FakeCompletions([e for e in events if e['kind'] in ('api_response', 'api_error')], speed)
+    replayed = MemoryRecorder()
+    main, app, listener = load_app(desktop, completions, replayed)
+    for event in events:
+        if event['kind'] == 'session':
+            for key in ('model', 'api_url', 'supported_apps', 'response_formats', 'prompt'):
+                main.settings[key] = event[key]
+            main.system_prompt_info = main.build_system_prompt(main.settings['prompt'])
+            break
+
+    triggers = deque(collect_triggers(events))
+
+    def run_trigger():
+        if not triggers:
+            return
+        trigger = triggers.popleft()
+        desktop.exe = trigger['exe']
+        desktop.copy(trigger['before'])
+        desktop.copied = trigger['copied']
+        listener.trigger_rephrase()
+
+    # Key events carry their recorded timestamps, so double-tap detection sees
+    # the recorded gaps whatever the replay speed.
+    key_clock = [0.0]
+    hotkey = main.DoubleCtrlListener(run_trigger, clock=lambda: key_clock[0])
+
+    def wait_until(deadline):
+        while time.perf_counter() < deadline:
+            app.processEvents()
+            time.sleep(0.001)
+
+    started = time.perf_counter()
+    first_t = events[0]['t'] if events else 0.0
+    for event in events:
+        if speed:
+            wait_until(started + (event['t'] - first_t) / speed)
+        if event['kind'] == 'key':
+            key_clock[0] = event['t']
+            hotkey.on_ctrl_press(None)
+            # The hotkey queue holds one trigger, so let the dispatcher pick it up
+            while not hotkey.pending.empty():
+                app.processEvents()
+                time.sleep(0.001)
+        elif event['kind'] == 'overlay' and event.get('event') == 'paste':
+            overlay = listener.overlay
+            if overlay is not None and overlay.isVisible():
+                overlay.eventFilter(overlay.text_view.viewport(), main.QtCore.QEvent(main.QtCore.QEvent.MouseButtonPress))
+        app.processEvents()
+
+    # Let outstanding workers deliver their results
+    expected = sum(1 for latency in trigger_latencies(events) if latency is not None)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        done = sum(1 for e in replayed.events if e['kind'] == 'overlay' and e.get('event') == 'result')
+        if done >= expected:
+            break
+        app.processEvents()
+        time.sleep(0.001)
+    return replayed.events
+
+
+def run_cycle(main, app, listener, idx, close_while_loading=False):
+    # One show -> result -> close cycle through a pooled overlay. Returns True
+    # when an overlay closed while loading was shown again by its late result.
+    listener.show_rephrase_overlay(f'Cycle {idx}: please rephrase this sentence.\nAnd this one as well.', 1)
+    overlay = listener.overlay
+    if close_while_loading:
+        # As the close button or the auto-close timer would
+        overlay.close()
+    while overlay.worker is not None or main.ManagedThread.live:
+        app.processEvents()
+        time.sleep(0.0005)
+    reopened = False
+    if close_while_loading:
+        app.processEvents()
+        reopened = overlay.isVisible()
+    overlay.close()
+    app.processEvents()
+    main.QtCore.QCoreApplication.sendPostedEvents(None, main.QtCore.QEvent.DeferredDelete)
+    return reopened
+
+
+def soak(cycles, warmup, max_growth_kb):
+    # Runs show -> result -> close cycles and compares resource counts after
+    # the warmup with those at the end. Returns True when nothing grew.
+    desktop = FakeDesktop()
+    main, app, listener = load_app(desktop, SyntheticCompletions(), MemoryRecorder())
+    main.recorder.enabled = False  # keep the soak from measuring its own event log
+    main.settings['response_formats'] = {
+        main.response_format_key(main.settings['api_url'], main.settings.get('model', 'gpt-3.5-turbo')): 'json_object'
+    }
+    reopened = []
+
+    def soak_cycle(idx):
+        # Every other cycle closes the overlay while it is still loading
+        if run_cycle(main, app, listener, idx, close_while_loading=bool(idx % 2)):
+            reopened.append(idx)
+
+    for idx in range(warmup):
+        soak_cycle(idx)
+    gc.collect()
+    tracemalloc.start()
+    baseline = main.collect_diagnostics()
+    started = time.perf_counter()
+    for idx in range(warmup, warmup + cycles):
+        soak_cycle(idx)
+        if (idx - warmup + 1) % 1000 == 0:
+            print(f'{idx - warmup + 1} cycles, {main.collect_diagnostics()}')
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    final = main.collect_diagnostics()
+    tracemalloc.stop()
+
+    print(f'{cycles} cycles in {elapsed:.1f} s ({elapsed / cycles * 1000:.2f} ms per cycle)')
+    ok = True
+    for name in ('live_qthreads', 'python_threads', 'widgets', 'top_level_widgets', 'pooled_overlays', 'pooled_notifications'):
+        print(f'{name:>22}: {baseline[name]} -> {final[name]}')
+        if final[name] > baseline[name]:
+            ok = False
+    growth_kb = final['traced_memory_kb'] - baseline['traced_memory_kb']
+    print(f'{"traced memory growth":>22}: {growth_kb} KB (limit {max_growth_kb} KB)')
+    print(f'{"reopened after close":>22}: {len(reopened)}')
+    return ok and growth_kb <= max_growth_kb and not reopened
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+def bench_hotkey(events, iterations):
+    # Times DoubleCtrlListener.on_ctrl_press, which runs on the keyboard hook
+    # thread, over the gaps between recorded Ctrl presses, or alternating
+    # single presses and double taps when there is no recording
+    main, app, listener = load_app(FakeDesktop(), SyntheticCompletions(), MemoryRecorder())
+    main.recorder.enabled = False  # as in a session without REPHRASER_RECORD
+    key_times = [event['t'] for event in events if event['kind'] == 'key']
+    gaps = [later - earlier for earlier, later in zip(key_times, key_times[1:])] or [1.0, 0.1]
+    dispatched = []
+    key_clock = [0.0]
+    hotkey = main.DoubleCtrlListener(lambda: dispatched.append(None), clock=lambda: key_clock[0])
+    samples = []
+    detected = 0
+    for idx in range(iterations):
+        key_clock[0] += gaps[idx % len(gaps)]
+        started = time.perf_counter_ns()
+        hotkey.on_ctrl_press(None)
+        samples.append((time.perf_counter_ns() - started) / 1000)
+        if hotkey.last_ctrl_press_time == float('-inf'):
+            detected += 1
+    time.sleep(0.1)  # let the dispatcher drain the last trigger
+    samples.sort()
+    # Presses come back to back here, so most double taps find one already queued and are dropped
+    print(f'{iterations} Ctrl presses, {detected} double taps detected, {len(dispatched)} dispatched')
+    print(f'on_ctrl_press: p50 {percentile(samples, 0.50):.1f} us, p99 {percentile(samples, 0.99):.1f} us, '
+          f'max {samples[-1]:.1f} us')
+    return True
+
+
+def bench_render(iterations):
+    # Times showing a result of 100, 5,000 and 50,000 lines: until the first
+    # screenful is painted, and until every chunk has been appended; medians
+    # over the iterations are printed
+    main, app, listener = load_app(FakeDesktop(), SyntheticCompletions(), MemoryRecorder())
+    main.recorder.enabled = False
+    overlay = main.overlay_pool.acquire()
+    print(f'{"lines":>7} {"first screen ms":>16} {"all lines ms":>13}')
+    for line_count in (100, 5000, 50000):
+        text = '\n'.join(f'Line {idx}: the quick brown fox jumps over the lazy dog.' for idx in range(line_count))
+        first_screen = []
+        all_lines = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            overlay.on_result_ready(text, False)
+            app.processEvents()
+            first_screen.append((time.perf_counter() - started) * 1000)
+            while overlay.pending_chunks:
+                app.processEvents()
+            all_lines.append((time.perf_counter() - started) * 1000)
+            overlay.close()
+            app.processEvents()
+        first_screen.sort()
+        all_lines.sort()
+        print(f'{line_count:>7} {percentile(first_screen, 0.5):>16.1f} {percentile(all_lines, 0.5):>13.1f}')
+    return True
+
+
+def bench_allocations(iterations, warmup=20):
+    # Counts the widgets constructed and the Python memory kept per trigger
+    # over show -> result -> close cycles, after a short warmup
+    main, app, listener = load_app(FakeDesktop(), SyntheticCompletions(), MemoryRecorder())
+    main.recorder.enabled = False
+    main.settings['response_formats'] = {
+        main.response_format_key(main.settings['api_url'], main.settings.get('model', 'gpt-3.5-turbo')): 'json_object'
+    }
+    constructed = {}
+    for pool in (main.overlay_pool, main.notification_pool):
+        def counting_factory(factory=pool.factory):
+            constructed[factory.__name__] = constructed.get(factory.__name__, 0) + 1
+            return factory()
+        counting_factory.__name__ = pool.factory.__name__
+        pool.factory = counting_factory
+        pool.prewarm()
+
+    def bench_cycle(idx):
+        run_cycle(main, app, listener, idx)
+        # The paste path sleeps, so only its notification is shown
+        notification = main.notification_pool.acquire()
+        notification.show_message('Rephrased text has been pasted.')
+        app.processEvents()
+        notification.close()
+
+    for idx in range(warmup):
+        bench_cycle(idx)
+    constructed.clear()
+    gc.collect()
+    tracemalloc.start()
+    widgets_before = len(app.allWidgets())
+    memory_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    for idx in range(warmup, warmup + iterations):
+        bench_cycle(idx)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'{iterations} triggers in {elapsed:.1f} s')
+    for name in ('RephraseOverlay', 'NotificationWindow'):
+        print(f'{name + " constructed":>30}: {constructed.get(name, 0)} ({constructed.get(name, 0) / iterations:.3f} per trigger)')
+    print(f'{"live widgets":>30}: {widgets_before} -> {len(app.allWidgets())}')
+    print(f'{"traced memory kept":>30}: {(memory_after - memory_before) / iterations:.1f} bytes per trigger')
+    print(f'{"traced memory peak":>30}: {(memory_peak - memory_before) // 1024} KB above the start')
+    return True
+
+
+def bench_selection(size_mb=10):
+    # Time and peak traced memory for a large selection: the worker building
+    # the request and reconstructing the result, then the overlay showing it.
+    # The synthetic API's own JSON parsing is included in the worker's peak.
+    main, app, listener = load_app(FakeDesktop(), SyntheticCompletions(), MemoryRecorder())
+    main.recorder.enabled = False
+    main.settings['response_formats'] = {
+        main.response_format_key(main.settings['api_url'], main.settings.get('model', 'gpt-3.5-turbo')): 'json_object'
+    }
+    line = 'The quick brown fox jumps over the lazy dog, then rests a while.'
+    text = '\r\n'.join([line] * (size_mb * 1024 * 1024 // (len(line) + 2)))
+    size_kb = len(text) // 1024
+    results = []
+    overlay = main.overlay_pool.acquire()
+
+    def run_worker():
+        worker = main.RephraseWorker(text)
+        worker.result_ready.connect(lambda result, is_error: results.append(result))
+        worker.run()
+
+    phases = []
+    for name, run in (('worker', run_worker), ('overlay', lambda: overlay.on_result_ready(results[0], False))):
+        # Tracing slows allocation down, so time one run and trace the peak of another
+        gc.collect()
+        started = time.perf_counter()
+        run()
+        app.processEvents()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        gc.collect()
+        tracemalloc.start()
+        run()
+        app.processEvents()
+        peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+        phases.append((name, elapsed_ms, peak_kb))
+    overlay.close()
+
+    print(f'{len(text.splitlines())} lines, {size_kb} KB selection')
+    for name, elapsed_ms, peak_kb in phases:
+        print(f'{name:>8}: {elapsed_ms:.0f} ms, peak {peak_kb} KB ({peak_kb / size_kb:.1f}x the selection)')
+    return True
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Replay a recorded GRephraser session headlessly.')
+    parser.add_argument('replay_file', nargs='?', help='JSON-lines file written with REPHRASER_RECORD')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed multiplier; 0 replays without waiting (default: 1)')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='seconds to wait for outstanding results after the last event')
+    parser.add_argument('--fail-over', type=float, default=None, metavar='MS',
+                        help='exit with status 1 if a replayed trigger is this many ms slower than recorded')
+    parser.add_argument('--soak', type=int, default=None, metavar='CYCLES',
+                        help='run this many synthetic rephrase cycles instead of replaying a file')
+    parser.add_argument('--soak-warmup', type=int, default=200,
+                        help='cycles run before the soak baseline is taken (default: 200)')
+    parser.add_argument('--max-growth-kb', type=int, default=1024,
+                        help='traced memory growth allowed over the soak (default: 1024)')
+    parser.add_argument('--bench', choices=['hotkey', 'render', 'allocations', 'selection'], default=None,
+                        help='time one part of the app instead of replaying; hotkey uses the key '
+                             'timing of the replay file when one is given')
+    parser.add_argument('--iterations', type=int, default=None,
+                        help='repetitions for --bench (default: 10000 for hotkey, 5 for render, '
+                             '1000 for allocations)')
+    args = parser.parse_args()
+
+    if args.bench == 'hotkey':
+        events = load_events(args.replay_file) if args.replay_file else []
+        return 0 if bench_hotkey(events, args.iterations or 10000) else 1
+    if args.bench == 'render':
+        return 0 if bench_render(args.iterations or 5) else 1
+    if args.bench == 'allocations':
+        return 0 if bench_allocations(args.iterations or 1000) else 1
+    if args.bench == 'selection':
+        return 0 if bench_selection() else 1
+    if args.soak is not None:
+        return 0 if soak(args.soak, args.soak_warmup, args.max_growth_kb) else 1
+    if args.replay_file is None:
+        parser.error('a replay file is required unless --soak is given')
+
+    events = load_events(args.replay_file)
+    recorded = trigger_latencies(events)
+    api_latencies = trigger_api_latencies(events)
+    replayed = trigger_latencies(replay(events, args.speed, args.timeout))
+
+    failed = False
+    print(f'{"trigger":>7} {"recorded ms":>12} {"expected ms":>12} {"replayed ms":>12}')
+    for idx, recorded_ms in enumerate(recorded):
+        replayed_ms = replayed[idx] if idx < len(replayed) else None
+        # Only the fake API sleeps are scaled by the replay speed; the rest of
+        # the trigger (clipboard waits, event loop) runs at its real pace
+        expected_ms = None
+        if recorded_ms is not None:
+            api_ms = api_latencies[idx]
+            expected_ms = recorded_ms - api_ms + (api_ms / args.speed if args.speed else 0)
+        print(f'{idx:>7} {format_ms(recorded_ms):>12} {format_ms(expected_ms):>12} {format_ms(replayed_ms):>12}')
+        if args.fail_over is not None and expected_ms is not None:
+            if replayed_ms is None or replayed_ms - expected_ms > args.fail_over:
+                failed = True
+    return 1 if failed else 0
+
+
+def format_ms(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())